@@ -0,0 +1,77 @@
+"""
+Quantiphyse - Shared base classes for FSL registration methods
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from PySide2 import QtWidgets
+
+from quantiphyse.gui.widgets import Citation
+from quantiphyse.gui.options import OptionBox
+from quantiphyse.utils import get_plugins
+
+# Look up the registration method base class once - modules which need it
+# import it from here rather than repeating the plugin scan
+RegMethod = get_plugins("base-classes", class_name="RegMethod")[0]
+
+class FslRegMethod(RegMethod):
+    """
+    Base class for registration methods implemented using FSL tools
+
+    Provides the options widget, which shows the method's citation above an
+    OptionBox. Subclasses set ``CITATION`` and add their options in
+    ``init_options``.
+    """
+
+    CITATION = None
+
+    def __init__(self, name, ivm, display_name):
+        RegMethod.__init__(self, name, ivm, display_name)
+        self.options_widget = None
+
+    def interface(self, generic_options=None):
+        """
+        :return: QWidget containing registration options
+        """
+        if generic_options is None:
+            generic_options = {}
+
+        if self.options_widget is None:
+            self.options_widget = QtWidgets.QWidget()
+            vbox = QtWidgets.QVBoxLayout()
+            self.options_widget.setLayout(vbox)
+
+            cite = Citation(*self.CITATION)
+            vbox.addWidget(cite)
+
+            self.optbox = OptionBox()
+            self.init_options(self.optbox)
+            vbox.addWidget(self.optbox)
+
+        return self.options_widget
+
+    def init_options(self, optbox):
+        """
+        Add method-specific options to the options box
+
+        :param optbox: OptionBox to add options to
+        """
+        pass
+
+    def options(self):
+        """
+        :return: Dictionary of registration options selected
+        """
+        self.interface()
+        return self.optbox.values()
@@ -15,51 +15,86 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import io
 import os
-import six
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from PySide2 import QtGui, QtCore, QtWidgets
+import numpy as np
 
 from quantiphyse.data import QpData, DataGrid, NumpyData
-from quantiphyse.gui.widgets import Citation
-from quantiphyse.gui.options import OptionBox, ChoiceOption, NumericOption
-from quantiphyse.utils import get_plugins
+from quantiphyse.gui.options import ChoiceOption, NumericOption
 from quantiphyse.utils.exceptions import QpException
 
-from .process import qpdata_to_fslimage, fslimage_to_qpdata
+from ._base import FslRegMethod
+from .process import qpdata_to_fslinput, fslimage_to_qpdata, nifti_output
 from .flirt_transform import FlirtTransform
 
 CITE_TITLE = "Improved Optimisation for the Robust and Accurate Linear Registration and Motion Correction of Brain Images"
 CITE_AUTHOR = "Jenkinson, M., Bannister, P., Brady, J. M. and Smith, S. M."
 CITE_JOURNAL = "NeuroImage, 17(2), 825-841, 2002"
 
-RegMethod = get_plugins("base-classes", class_name="RegMethod")[0]
-
 def _interp(order):
     return {0 : "nearestneighbour", 1 : "trilinear", 2 : "spline", 3 : "spline"}[order]
 
-def set_environ(options):    
-    for env_copy in ["FSLOUTPUTTYPE", "FSLDIR", "FSLDEVDIR"]:
+def set_environ(options):
+    for env_copy in ["FSLDIR", "FSLDEVDIR"]:
         if env_copy in options:
             os.environ[env_copy] = options.pop(env_copy)
-            
-    if "FSLOUTPUTTYPE" not in os.environ:
-        os.environ["FSLOUTPUTTYPE"] = "NIFTI_GZ"
 
-class FlirtRegMethod(RegMethod):
+    # Output type is always uncompressed NIfTI - see nifti_output - but
+    # options saved by older versions may still include it
+    options.pop("FSLOUTPUTTYPE", None)
+
+class _McflirtProgress(object):
+    """
+    Log stream for MCFLIRT which also reports progress on the method queue
+
+    With the ``-report`` option MCFLIRT prints a line for each search stage,
+    e.g. ``Registering volumes ... [1][2][3]``, with a marker for each volume.
+    fslpy forwards MCFLIRT output a line at a time, so all the markers for a
+    stage arrive together when the stage finishes. Progress is therefore only
+    updated once per stage, not once per volume.
+    """
+
+    VOLUME_MARKER = re.compile(r"\[\d+\]")
+
+    def __init__(self, log, queue, total):
+        self._log = log
+        self._queue = queue
+        self._total = max(total, 1)
+        self._done = 0
+
+    def write(self, text):
+        self._log.write(text)
+        if self._queue is not None and "Registering volumes" in text:
+            self._done += len(self.VOLUME_MARKER.findall(text))
+            self._queue.put(min(1.0, float(self._done) / self._total))
+
+    def flush(self):
+        self._log.flush()
+
+class FlirtRegMethod(FslRegMethod):
     """
     FLIRT/MCFLIRT registration method
     """
 
+    CITATION = (CITE_TITLE, CITE_AUTHOR, CITE_JOURNAL)
+
+    COST_MODELS = (
+        ("Mutual information", "mutualinfo"),
+        ("Woods", "woods"),
+        ("Correlation ratio", "corratio"),
+        ("Normalized correlation", "normcorr"),
+        ("Normalized mutual information", "normmi"),
+        ("Least squares", "leastsq"),
+    )
+
     def __init__(self, ivm):
-        RegMethod.__init__(self, "flirt", ivm, "FLIRT/MCFLIRT")
-        self.options_widget = None
-        self.cost_models = ["Mutual information", "Woods", "Correlation ratio",
-                            "Normalized correlation", "Normalized mutual information",
-                            "Least squares"]
-        self.cost_model_options = ["mutualinfo", "woods", "corratio", "normcorr",
-                                   "normmi", "leastsq"]
-        
+        FslRegMethod.__init__(self, "flirt", ivm, "FLIRT/MCFLIRT")
+
     @classmethod
     def apply_transform(cls, reg_data, transform, options, queue):
         """
@@ -91,16 +126,28 @@ class FlirtRegMethod(RegMethod):
         """
         Static function for performing 3D registration
         """
-        from fsl import wrappers as fsl
-        reg = qpdata_to_fslimage(reg_data)
-        ref = qpdata_to_fslimage(ref_data)
-
         set_environ(options)
+        with nifti_output():
+            return cls._flirt(reg_data, ref_data, qpdata_to_fslinput(ref_data), options)
+
+    @classmethod
+    def _flirt(cls, reg_data, ref_data, ref, options):
+        """
+        Register 3D data to a reference using FLIRT
+
+        This does not modify the environment so it can run in several threads at
+        once. The caller must apply ``set_environ`` and ``nifti_output`` first.
+
+        :param ref: Reference data as an FSL input, i.e. a NIfTI file name or
+                    an fsl.data.Image, defined on the grid of ``ref_data``
+        """
+        from fsl import wrappers as fsl
+        reg = qpdata_to_fslinput(reg_data)
 
         output_space = options.pop("output-space", "ref")
         interp = _interp(options.pop("interp-order", 1))
         twod = reg_data.grid.shape[2] == 1
-        logstream = six.StringIO()
+        logstream = io.StringIO()
         flirt_output = fsl.flirt(reg, ref, interp=interp, out=fsl.LOAD, omat=fsl.LOAD, twod=twod, log={"cmd" : logstream, "stdout" : logstream, "stderr" : logstream}, **options)
         transform = FlirtTransform(ref_data.grid, flirt_output["omat"], name="flirt_xfm")
 
@@ -116,6 +163,52 @@ class FlirtRegMethod(RegMethod):
             
         return qpdata, transform, logstream.getvalue()
       
+    @classmethod
+    def reg_batch(cls, reg_list, ref_data, options, queue, n_workers=None):
+        """
+        Register a number of 3D data sets to the same reference in parallel
+
+        Each registration runs FLIRT as a separate process, so a thread pool is
+        sufficient - the threads spend almost all their time waiting for FLIRT.
+
+        :param reg_list: Sequence of 3D QpData instances to register
+        :param ref_data: 3D QpData instance to register them to
+        :param options: Method options as dictionary, as for ``reg_3d``
+        :param queue: Queue object which method may put progress information on to
+        :param n_workers: Maximum number of simultaneous registrations. Defaults
+                          to the number of CPUs
+        
+        :return: Sequence of ``(qpdata, transform, log)`` tuples as returned by
+                 ``reg_3d``, in the same order as ``reg_list``
+        """
+        # Set up the environment once here - the registration threads must not
+        # modify it while other threads are starting FLIRT
+        options = dict(options)
+        set_environ(options)
+
+        # fslpy writes an in-memory image input to a new temporary file on every
+        # call, so save the reference once and pass the file to each registration
+        ref = qpdata_to_fslinput(ref_data)
+        tmpdir = None
+        try:
+            if not isinstance(ref, str):
+                tmpdir = tempfile.mkdtemp(prefix="qpfsl_")
+                ref_fname = os.path.join(tmpdir, "ref.nii")
+                ref.save(ref_fname)
+                ref = ref_fname
+
+            with nifti_output(), ThreadPoolExecutor(max_workers=n_workers or os.cpu_count()) as executor:
+                futures = [executor.submit(cls._flirt, reg_data, ref_data, ref, dict(options))
+                           for reg_data in reg_list]
+                for done, _ in enumerate(as_completed(futures)):
+                    if queue is not None:
+                        queue.put(float(done + 1) / len(futures))
+        finally:
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+        return [future.result() for future in futures]
+
     @classmethod
     def moco(cls, moco_data, ref, options, queue):
         """
@@ -147,68 +240,103 @@ class FlirtRegMethod(RegMethod):
 
         set_environ(options)
 
-        reg = qpdata_to_fslimage(moco_data)
+        reg = qpdata_to_fslinput(moco_data)
 
         if isinstance(ref, int):
             options["refvol"] = ref
             ref_grid = moco_data.grid
         elif isinstance(ref, QpData):
-            options["reffile"] = qpdata_to_fslimage(ref)
+            options["reffile"] = qpdata_to_fslinput(ref)
             ref_grid = ref.grid
         else:
             raise QpException("invalid reference object type: %s" % type(ref))
 
         interp = _interp(options.pop("interp-order", 1)) # FIXME ignored
         twod = moco_data.grid.shape[2] == 1
-        logstream = six.StringIO()
-        result = fsl.mcflirt(reg, out=fsl.LOAD, mats=fsl.LOAD, twod=twod, log={"cmd" : logstream, "stdout" : logstream, "stderr" : logstream}, **options)
+        logstream = io.StringIO()
+        progress = _McflirtProgress(logstream, queue, moco_data.nvols * options.get("stages", 3))
+        with nifti_output():
+            result = fsl.mcflirt(reg, out=fsl.LOAD, mats=fsl.LOAD, twod=twod, report=True, log={"cmd" : logstream, "stdout" : progress, "stderr" : progress}, **options)
         qpdata = fslimage_to_qpdata(result["out"], moco_data.name)
         transforms = [FlirtTransform(ref_grid, result[os.path.join("out.mat", "MAT_%04i" % vol)]) for vol in range(moco_data.nvols)]
         
         return qpdata, transforms, logstream.getvalue()
-  
-    def interface(self, generic_options=None):
+
+    @classmethod
+    def moco_batch(cls, volumes, ref, options, queue):
         """
-        :return: QWidget containing registration options
+        Motion correct a sequence of 3D volumes using a single MCFLIRT run
+
+        The volumes are stacked into a 4D data set and passed to ``moco`` so
+        that MCFLIRT is only invoked once rather than once per volume. The
+        motion corrected data is split back into one data set per volume.
+
+        A single volume cannot be passed to MCFLIRT as it would be 3D data. If
+        ``ref`` is an index it is the reference volume itself, so it is returned
+        unchanged with an identity transformation. Otherwise it is registered
+        to ``ref`` using FLIRT with the same options.
+
+        :param volumes: Sequence of 3D QpData instances defined on the same grid
+        :param ref: As for ``moco``. An integer is interpreted as an index into ``volumes``
+        :param options: Method options as dictionary
+        :param queue: Queue object which method may put progress information on to
+
+        :return: Tuple of three items. First, sequence of motion corrected 3D QpData
+                 instances, one for each of ``volumes`` with the same names. Second,
+                 sequence of transformations, one for each input volume. Third, log
+                 information from the registration as a string.
         """
-        if generic_options is None:
-            generic_options = {}
-            
-        if self.options_widget is None:    
-            self.options_widget = QtWidgets.QWidget()  
-            vbox = QtWidgets.QVBoxLayout()
-            self.options_widget.setLayout(vbox)
-
-            cite = Citation(CITE_TITLE, CITE_AUTHOR, CITE_JOURNAL)
-            vbox.addWidget(cite)
-
-            self.optbox = OptionBox()
-            self.optbox.add("Cost Model", ChoiceOption(self.cost_models, self.cost_model_options, default="normcorr"), key="cost")
-            #self.optbox.add("Number of search stages", ChoiceOption([1, 2, 3, 4]), key="nstages")
-            #self.optbox.option("stages").value = 2
-            #self.optbox.add("Final stage interpolation", ChoiceOption(["None", "Sinc", "Spline", "Nearest neighbour"], ["", "sinc_final", "spline_final", "nn_final"]), key="final")
-            #self.optbox.add("Field of view (mm)", NumericOption(minval1, maxval=100, default=20), key="fov")
-            self.optbox.add("Number of bins", NumericOption(intonly=True, minval=1, maxval=1000, default=256), key="bins")
-            self.optbox.add("Degrees of freedom", ChoiceOption([6, 9, 12]), key="dof")
-            #self.optbox.add("Scaling", NumericOption(minval=0.1, maxval=10, default=6), key="scaling")
-            #self.optbox.add("Smoothing in cost function", NumericOption(minval=0.1, maxval=10, default=1), key="smoothing")
-            #self.optbox.add("Scaling factor for rotation\noptimization tolerances", NumericOption(minval=0.1, maxval=10, default=1), key="rotscale")
-            #self.optbox.add("Search on gradient images", BoolOption, key="grad")
-
-            vbox.addWidget(self.optbox)
-        return self.options_widget
+        if not volumes:
+            raise QpException("No volumes given to motion correct")
+        if isinstance(ref, int) and not 0 <= ref < len(volumes):
+            raise QpException("Reference volume index out of range: %i" % ref)
+
+        grid = volumes[0].grid
+        for vol in volumes[1:]:
+            if not vol.grid.matches(grid):
+                raise QpException("Volumes to motion correct must all be on the same grid")
+
+        if len(volumes) == 1:
+            vol = volumes[0]
+            if isinstance(ref, QpData):
+                reg_options = dict(options)
+                reg_options["output-space"] = "reg"
+                qpdata, transform, log = cls.reg_3d(vol, ref, reg_options, queue)
+                return [qpdata], [transform], log
+            qpdata = NumpyData(vol.raw(), grid=grid, name=vol.name)
+            return [qpdata], [FlirtTransform(grid, np.identity(4))], ""
+
+        data = np.stack([vol.raw() for vol in volumes], axis=-1)
+        moco_data = NumpyData(data, grid=grid, name=volumes[0].name)
+        moco_output, transforms, log = cls.moco(moco_data, ref, dict(options), queue)
+        corrected = [NumpyData(moco_output.volume(idx), grid=moco_output.grid, name=vol.name)
+                     for idx, vol in enumerate(volumes)]
+        return corrected, transforms, log
+  
+    def init_options(self, optbox):
+        cost_names, cost_options = zip(*self.COST_MODELS)
+        optbox.add("Cost Model", ChoiceOption(list(cost_names), list(cost_options), default="normcorr"), key="cost")
+        #optbox.add("Number of search stages", ChoiceOption([1, 2, 3, 4]), key="nstages")
+        #optbox.option("stages").value = 2
+        #optbox.add("Final stage interpolation", ChoiceOption(["None", "Sinc", "Spline", "Nearest neighbour"], ["", "sinc_final", "spline_final", "nn_final"]), key="final")
+        #optbox.add("Field of view (mm)", NumericOption(minval1, maxval=100, default=20), key="fov")
+        optbox.add("Number of bins", NumericOption(intonly=True, minval=1, maxval=1000, default=256), key="bins")
+        optbox.add("Degrees of freedom", ChoiceOption([6, 9, 12]), key="dof")
+        #optbox.add("Scaling", NumericOption(minval=0.1, maxval=10, default=6), key="scaling")
+        #optbox.add("Smoothing in cost function", NumericOption(minval=0.1, maxval=10, default=1), key="smoothing")
+        #optbox.add("Scaling factor for rotation\noptimization tolerances", NumericOption(minval=0.1, maxval=10, default=1), key="rotscale")
+        #optbox.add("Search on gradient images", BoolOption, key="grad")
 
     def options(self):
         """
         :return: Dictionary of registration options selected
         """
-        self.interface()
-        opts = self.optbox.values()
-        for env_copy in ["FSLOUTPUTTYPE", "FSLDIR", "FSLDEVDIR"]:
+        opts = FslRegMethod.options(self)
+        for env_copy in ["FSLDIR", "FSLDEVDIR"]:
             if env_copy in os.environ:
                 opts[env_copy] = os.environ[env_copy]
             else:
-                self.debug("%s is not in environment" % env_copy)
+                self.debug("%s is not in environment", env_copy)
 
         for key, value in opts.items():
             self.debug("%s: %s", key, value)
@@ -16,14 +16,11 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import csv
+import io
 
-import six
 import numpy as np
 
 from quantiphyse.data.extras import Extra
-from quantiphyse.utils import get_plugins
-
-RegMethod = get_plugins("base-classes", class_name="RegMethod")[0]
 
 class FlirtTransform(Extra):
     """
@@ -42,7 +39,7 @@ class FlirtTransform(Extra):
         the reference space which means they are unusable without a reference image.
         We get around this by saving the reference space commented out
         """
-        stream = six.StringIO()
+        stream = io.StringIO()
         writer = csv.writer(stream, delimiter='\t', lineterminator='\n')
         
         for row in self.ref_grid.affine:
@@ -15,33 +15,30 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
-import six
+import io
 
-from PySide2 import QtGui, QtCore, QtWidgets
-
-from quantiphyse.gui.widgets import Citation
-from quantiphyse.gui.options import OptionBox, DataOption, ChoiceOption
-from quantiphyse.utils import get_plugins
+from quantiphyse.gui.options import DataOption, ChoiceOption
 from quantiphyse.utils.exceptions import QpException
 
-from .process import qpdata_to_fslimage, fslimage_to_qpdata
+from ._base import FslRegMethod
+from .process import qpdata_to_fslimage, qpdata_to_fslinput, fslimage_to_qpdata
 
 CITE_TITLE = "Non-linear registration, aka spatial normalisation"
 CITE_AUTHOR = "Andersson JLR, Jenkinson M, Smith S"
 CITE_JOURNAL = "FMRIB technical report TR07JA2, 2010"
 
-RegMethod = get_plugins("base-classes", class_name="RegMethod")[0]
-
 def _interp(order):
     return {0 : "nn", 1 : "trilinear", 2 : "spline", 3 : "spline"}[order]
 
-class FnirtRegMethod(RegMethod):
+class FnirtRegMethod(FslRegMethod):
     """
     FNIRT registration method
     """
+
+    CITATION = (CITE_TITLE, CITE_AUTHOR, CITE_JOURNAL)
+
     def __init__(self, ivm):
-        RegMethod.__init__(self, "fnirt", ivm, display_name="FNIRT")
-        self.options_widget = None
+        FslRegMethod.__init__(self, "fnirt", ivm, display_name="FNIRT")
 
     @classmethod
     def apply_transform(cls, reg_data, transform, options, queue):
@@ -61,7 +58,7 @@ class FnirtRegMethod(RegMethod):
         # as the reference space
         ref = qpdata_to_fslimage(transform.volume(0, qpdata=True))
 
-        log = six.StringIO()
+        log = io.StringIO()
         order = options.pop("interp-order", 1)
         interp = _interp(order)
         apply_output = fsl.applywarp(reg, ref, interp=interp, paddingsize=1, super=True, superlevel="a", 
@@ -74,7 +71,7 @@ class FnirtRegMethod(RegMethod):
             pass
         else:
             qpdata = qpdata.resample(reg_data.grid, suffix="", order=order)
-            log += "Resampling onto input grid\n"
+            log.write("Resampling onto input grid\n")
 
         return qpdata, log.getvalue()
 
@@ -90,10 +87,10 @@ class FnirtRegMethod(RegMethod):
             raise QpException("FNIRT does not support output in transformed space")
 
         from fsl import wrappers as fsl
-        reg = qpdata_to_fslimage(reg_data)
-        ref = qpdata_to_fslimage(ref_data)
+        reg = qpdata_to_fslinput(reg_data)
+        ref = qpdata_to_fslinput(ref_data)
         
-        log = six.StringIO()
+        log = io.StringIO()
         fnirt_output = fsl.fnirt(reg, ref=ref, iout=fsl.LOAD, fout=fsl.LOAD, log={"cmd" : log, "stdout" : log, "stderr" : log}, **options)
         transform = fslimage_to_qpdata(fnirt_output["fout"], name="fnirt_warp")
         transform.metadata["QpReg"] = "FNIRT"
@@ -105,27 +102,8 @@ class FnirtRegMethod(RegMethod):
 
         return qpdata, transform, log.getvalue()
       
-    def interface(self, generic_options=None):
-        if generic_options is None:
-            generic_options = {}
-
-        if self.options_widget is None:    
-            self.options_widget = QtWidgets.QWidget()  
-            vbox = QtWidgets.QVBoxLayout()
-            self.options_widget.setLayout(vbox)
-
-            cite = Citation(CITE_TITLE, CITE_AUTHOR, CITE_JOURNAL)
-            vbox.addWidget(cite)
-
-            self.optbox = OptionBox()
-            self.optbox.add("Mask for registration data", DataOption(self.ivm, rois=True, data=False), key="inmask", checked=True)
-            self.optbox.add("Mask for reference data", DataOption(self.ivm, rois=True, data=False), key="refmask", checked=True)
-            self.optbox.add("Spline order", ChoiceOption([2, 3]), key="splineorder", checked=True)
-            self.optbox.add("Use pre-defined configuration", ChoiceOption(["T1_2_MNI152_2mm", "FA_2_FMRIB58_1mm"]), key="config", checked=True)
-            vbox.addWidget(self.optbox)
-
-        return self.options_widget
-
-    def options(self):
-        self.interface()
-        return self.optbox.values()
+    def init_options(self, optbox):
+        optbox.add("Mask for registration data", DataOption(self.ivm, rois=True, data=False), key="inmask", checked=True)
+        optbox.add("Mask for reference data", DataOption(self.ivm, rois=True, data=False), key="refmask", checked=True)
+        optbox.add("Spline order", ChoiceOption([2, 3]), key="splineorder", checked=True)
+        optbox.add("Use pre-defined configuration", ChoiceOption(["T1_2_MNI152_2mm", "FA_2_FMRIB58_1mm"]), key="config", checked=True)
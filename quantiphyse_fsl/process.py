@@ -20,26 +20,86 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import contextlib
 import os
+import queue as _queue
 import re
+import shutil
+import tempfile
 import traceback
+from collections import namedtuple
 
 import numpy as np
 
 from quantiphyse.data import QpData, NumpyData, DataGrid
 from quantiphyse.processes import Process
 from quantiphyse.utils import QpException
-from quantiphyse.utils.cmdline import OutputStreamMonitor
 
 _LOAD = "Pickleable replacement for fsl.wrappers.LOAD special value, hope nobody is daft enough to pass this string as a parameter value"
 
 def qpdata_to_fslimage(qpd):
-    """ Convert QpData to fsl.data.Image"""
+    """
+    Convert QpData to fsl.data.Image
+
+    The image wraps the QpData array directly, no copy of the data is made
+    """
     from fsl.data.image import Image
     return Image(qpd.raw(), name=qpd.name, xform=qpd.grid.affine)
 
+def _nifti_fname(qpd):
+    """
+    :return: Name of the NIfTI file QpData was loaded from, or None if it
+             did not come from a NIfTI file which is still on disk and
+             matches the data
+
+    QpData.fname only records where the data came from. The data may since
+    have been reshaped, e.g. forced to 2D+t, or the file may have been saved
+    from a resampled copy. So the file is only used if the data has not been
+    reshaped and the file header has the same shape, number of volumes and
+    affine as the data grid. Reading the header does not read the image data.
+    """
+    fname = getattr(qpd, "fname", None)
+    if not fname or not fname.endswith((".nii", ".nii.gz")) or not os.path.isfile(fname):
+        return None
+
+    metadata = getattr(qpd, "metadata", None) or {}
+    if metadata.get("raw_2dt", False):
+        return None
+
+    try:
+        import nibabel as nib
+        img = nib.load(fname)
+    except Exception:
+        return None
+
+    shape = list(img.shape[:4]) + [1] * (4 - len(img.shape))
+    if len(img.shape) > 4 or tuple(shape[:3]) != tuple(qpd.grid.shape) or shape[3] != qpd.nvols:
+        return None
+    if not np.allclose(img.affine, qpd.grid.affine):
+        return None
+    return fname
+
+def qpdata_to_fslinput(qpd):
+    """
+    Convert QpData to an input argument for an fsl.wrappers function
+
+    If the data was loaded from a NIfTI file which is still on disk and
+    matches the data (see _nifti_fname), the file name is returned so the
+    FSL tool can read it directly instead of the data being saved again to
+    a temporary file. Otherwise an fsl.data.Image is returned.
+    """
+    fname = _nifti_fname(qpd)
+    if fname:
+        return fname
+    return qpdata_to_fslimage(qpd)
+
 def fslimage_to_qpdata(img, name=None, vol=None, region=None, roi=False):
-    """ Convert fsl.data.Image to QpData """
+    """
+    Convert fsl.data.Image to QpData
+
+    The QpData shares the image data array (or a view of a single volume of it)
+    unless a region is selected, in which case a new integer mask is created
+    """
     if not name: name = img.name
     if vol is not None:
         data = img.data[..., vol]
@@ -49,7 +109,222 @@ def fslimage_to_qpdata(img, name=None, vol=None, region=None, roi=False):
         data = (data == region).astype(np.int32)
     return NumpyData(data, grid=DataGrid(img.shape[:3], img.voxToWorldMat), name=name, roi=roi)
 
-def _run_fsl(worker_id, queue, fsldir, fsldevdir, cmd, cmd_args):
+# Description of image data passed to the worker process in shared memory
+_SharedImage = namedtuple("_SharedImage", ["shm_name", "shape", "dtype", "affine", "name"])
+
+def _create_shm(nbytes):
+    """
+    Create a new shared memory block of at least ``nbytes``
+
+    On Linux the block is a file in /dev/shm whose pages are only allocated
+    when they are first written. If /dev/shm is full, copying data into the
+    block kills the process with SIGBUS rather than raising an exception, so
+    the space is reserved up front where possible. This raises OSError if
+    there is not enough room.
+    """
+    from multiprocessing.shared_memory import SharedMemory
+    shm = SharedMemory(create=True, size=max(nbytes, 1))
+    fd = getattr(shm, "_fd", -1)
+    if fd >= 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, shm.size)
+        except OSError:
+            shm.close()
+            shm.unlink()
+            raise
+    return shm
+
+def _share_qpdata(qpd):
+    """
+    Copy the data in QpData into a new shared memory block
+
+    Requires Python 3.8 or later, ImportError is raised otherwise. OSError
+    is raised if the block could not be created.
+
+    :return: Tuple of (SharedMemory, _SharedImage). The caller owns the shared
+             memory and must close and unlink it when the worker has finished
+    """
+    arr = qpd.raw()
+    shm = _create_shm(arr.nbytes)
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, _SharedImage(shm.name, arr.shape, arr.dtype.str, qpd.grid.affine, qpd.name)
+
+def _shared_to_fslimage(shared):
+    """
+    Create an fsl.data.Image which wraps image data in shared memory
+
+    :return: Tuple of (SharedMemory, Image). The shared memory must remain
+             open while the image is in use
+    """
+    from multiprocessing.shared_memory import SharedMemory
+    from fsl.data.image import Image
+    shm = SharedMemory(name=shared.shm_name)
+    arr = np.ndarray(shared.shape, dtype=shared.dtype, buffer=shm.buf)
+    return shm, Image(arr, name=shared.name, xform=shared.affine)
+
+def _share_fslimage(img, name):
+    """
+    Copy the data in an fsl.data.Image into a new shared memory block
+
+    Used in the worker to return output data to the parent process, which
+    takes ownership of the block. Raises ImportError if shared memory is not
+    supported and OSError if the block could not be created.
+
+    :return: _SharedImage describing the data
+    """
+    arr = img.data
+    shm = _create_shm(arr.nbytes)
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    shared = _SharedImage(shm.name, arr.shape, arr.dtype.str, img.voxToWorldMat, name)
+
+    # The block is left registered with the resource tracker, which the worker
+    # shares with the parent because FslProcess.run starts it before the pool.
+    # So if the parent never collects the block (e.g. the run was cancelled)
+    # it is still removed when Quantiphyse exits
+    shm.close()
+    return shared
+
+def _shared_to_qpdata(shared):
+    """
+    Copy image data returned by the worker in shared memory into QpData and
+    release the shared memory block
+    """
+    from multiprocessing.shared_memory import SharedMemory
+    shm = SharedMemory(name=shared.shm_name)
+    try:
+        data = np.ndarray(shared.shape, dtype=shared.dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return NumpyData(data, grid=DataGrid(shared.shape[:3], shared.affine), name=shared.name)
+
+# Image data passed from the worker process as an uncompressed NIfTI file
+_NiftiImage = namedtuple("_NiftiImage", ["fname", "name"])
+
+def _nifti_to_qpdata(saved):
+    """
+    Load image data returned by the worker in a NIfTI file into QpData
+
+    The file is read into memory rather than memory-mapped so the temporary
+    directory containing it can be removed afterwards
+    """
+    import nibabel as nib
+    img = nib.load(saved.fname, mmap=False)
+    data = np.asanyarray(img.dataobj)
+    return NumpyData(data, grid=DataGrid(img.shape[:3], img.affine), name=saved.name)
+
+def _output_to_qpdata(val):
+    """
+    Convert an image returned by the worker process into QpData
+    """
+    if isinstance(val, _SharedImage):
+        return _shared_to_qpdata(val)
+    elif isinstance(val, _NiftiImage):
+        return _nifti_to_qpdata(val)
+    return val
+
+def _close_shm(shm_blocks, unlink=False):
+    """
+    Close (and optionally unlink) a sequence of shared memory blocks
+    """
+    for shm in shm_blocks:
+        try:
+            shm.close()
+        except BufferError:
+            # Arrays still refer to the block - the mapping is released
+            # when they are garbage collected instead
+            pass
+        if unlink:
+            shm.unlink()
+
+class FslOutputProgress(object):
+    """
+    Output stream for FSL wrapper commands which sends complete lines of
+    output to the main process via a queue
+
+    Partial lines are held back until the rest of the line is written, and
+    the complete lines from each write are put on the queue as a single list
+    """
+
+    def __init__(self, queue):
+        self._queue = queue
+        self._buf = ""
+
+    def write(self, text):
+        lines = (self._buf + text).replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        self._buf = lines.pop()
+        if lines:
+            self._queue.put(lines)
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        """
+        Send any remaining partial line once the command has completed
+        """
+        if self._buf:
+            self._queue.put([self._buf])
+            self._buf = ""
+
+# FSLDIR and FSLDEVDIR as last read from the environment - see fsl_env
+_FSL_ENV = None
+
+def fsl_env():
+    """
+    :return: Tuple of FSLDIR, FSLDEVDIR. Either may be None if not set
+    """
+    global _FSL_ENV
+    if _FSL_ENV is None:
+        _FSL_ENV = (os.environ.get("FSLDIR", None), os.environ.get("FSLDEVDIR", None))
+    return _FSL_ENV
+
+def refresh_fsl_env():
+    """
+    Discard the cached FSL environment so it is read again on next use
+
+    This must be called whenever FSLDIR or FSLDEVDIR are changed in os.environ
+    """
+    global _FSL_ENV
+    _FSL_ENV = None
+
+@contextlib.contextmanager
+def nifti_output():
+    """
+    Context manager which makes FSL tools write uncompressed NIfTI files
+
+    Outputs loaded back using fsl.LOAD are only intermediate files, so there is
+    no point compressing them. The previous FSLOUTPUTTYPE is restored on exit
+    so the setting does not leak into the rest of the session, e.g. when a
+    command runs in the main process
+    """
+    saved = os.environ.get("FSLOUTPUTTYPE", None)
+    os.environ["FSLOUTPUTTYPE"] = "NIFTI"
+    try:
+        yield
+    finally:
+        if saved is None:
+            del os.environ["FSLOUTPUTTYPE"]
+        else:
+            os.environ["FSLOUTPUTTYPE"] = saved
+
+def _worker_arg(val, fslwrap, shm_blocks):
+    """
+    Convert an argument received by the worker into the value passed to the FSL wrapper
+
+    QpData arguments never reach the worker - see FslProcess.run - so only shared
+    memory images and the LOAD placeholder need converting. Shared memory blocks
+    which are opened are added to ``shm_blocks`` so they can be closed afterwards.
+    """
+    if isinstance(val, _SharedImage):
+        shm, img = _shared_to_fslimage(val)
+        shm_blocks.append(shm)
+        return img
+    elif isinstance(val, str) and val == _LOAD:
+        return fslwrap.LOAD
+    return val
+
+def _run_fsl(worker_id, queue, fsldir, fsldevdir, tmpdir, cmd, cmd_args):
     """
     Background process worker function which runs an FSL wrapper command
     
@@ -58,12 +333,17 @@ def _run_fsl(worker_id, queue, fsldir, fsldevdir, cmd, cmd_args):
     is not pickleable and therefore cannot be passed as a multiprocessing 
     parameter. Also, the special fsl.LOAD object is not pickleable either
     so we pass our own special LOAD object (which is just a magic string).
+
+    Input data held in memory is passed in shared memory blocks described
+    by _SharedImage so the arrays do not need to be pickled. Output data is
+    returned in the same way where possible. This is not done on Windows
+    where a shared memory block is destroyed as soon as the worker closes it,
+    instead outputs are saved as uncompressed NIfTI files in ``tmpdir``.
     """
+    shm_blocks = []
     try:
         from fsl.data.image import Image
         import fsl.wrappers as fslwrap
-        if "FSLOUTPUTTYPE" not in os.environ:
-            os.environ["FSLOUTPUTTYPE"] = "NIFTI_GZ"
         if fsldir:
             os.environ["FSLDIR"] = fsldir
         if fsldevdir:
@@ -72,26 +352,40 @@ def _run_fsl(worker_id, queue, fsldir, fsldevdir, cmd, cmd_args):
         # Get the FSL wrapper function from the name of the command
         cmd_fn = getattr(fslwrap, cmd)
         
-        for key in cmd_args.keys():
-            val = cmd_args[key]
-            if isinstance(val, QpData):
-                cmd_args[key] = qpdata_to_fslimage(val)
-            elif val == _LOAD:
-                cmd_args[key] = fslwrap.LOAD
-
-        progress_watcher = OutputStreamMonitor(queue)
-        cmd_result = cmd_fn(log={"stdout" : progress_watcher, "cmd" : progress_watcher}, **cmd_args)
+        cmd_args = {key : _worker_arg(val, fslwrap, shm_blocks) for key, val in cmd_args.items()}
+
+        progress_watcher = FslOutputProgress(queue)
+        with nifti_output():
+            cmd_result = cmd_fn(log={"stdout" : progress_watcher, "cmd" : progress_watcher}, **cmd_args)
+        progress_watcher.finish()
+        cmd_args = None
         
         ret = {}
         for key in cmd_result.keys():
             val = cmd_result[key]
             if isinstance(val, Image):
-                ret[key] = fslimage_to_qpdata(val, key)
+                ret[key] = None
+                if os.name == "posix":
+                    try:
+                        ret[key] = _share_fslimage(val, key)
+                    except (ImportError, OSError):
+                        pass
+                if ret[key] is None and tmpdir:
+                    fname = os.path.join(tmpdir, "out_%i.nii" % len(ret))
+                    val.save(fname)
+                    ret[key] = _NiftiImage(fname, key)
+                if ret[key] is None:
+                    ret[key] = fslimage_to_qpdata(val, key)
                 
         return worker_id, True, ret
     except Exception as exc:
-        traceback.print_exc()
+        # Quantiphyse logs the log attribute of a failed worker's output in
+        # the main process, so pass the traceback back that way rather than
+        # writing to stderr from the worker
+        exc.log = traceback.format_exc()
         return worker_id, False, exc
+    finally:
+        _close_shm(shm_blocks)
 
 class FslProcess(Process):
     """
@@ -101,6 +395,12 @@ class FslProcess(Process):
 
     def __init__(self, ivm, **kwargs):
         Process.__init__(self, ivm, worker_fn=_run_fsl, **kwargs)
+        self._shm_blocks = []
+        self._tmpdir = None
+
+        # finished() is only called when the run succeeds, but sig_finished
+        # is emitted after every run however it ended
+        self.sig_finished.connect(self._run_finished)
      
     def run(self, options):
         """
@@ -110,20 +410,55 @@ class FslProcess(Process):
         self._output_data = {}
         self._output_rois = {}
         self._expected_steps = []
+        self._expected_regexes = []
         self._current_step = 0
         self._current_data = None
         self._current_roi = None
 
         # Get the command to run and it's arguments (as a dict)
-        fsldir, fsldevdir = None, None
-        if "FSLDIR" in os.environ:
-            fsldir = os.environ["FSLDIR"]
-        if "FSLDEVDIR" in os.environ:
-            fsldevdir = os.environ["FSLDEVDIR"]
+        fsldir, fsldevdir = fsl_env()
         cmd, cmd_args = self.init_cmd(options)
-
-        # Run as background process
-        args = [fsldir, fsldevdir, cmd, cmd_args]
+        self._expected_regexes = [re.compile(step) if step is not None else None for step in self._expected_steps]
+
+        # Avoid pickling QpData inputs. Data loaded from a NIfTI file whose
+        # header still matches the data grid is passed by file name and read
+        # directly by the FSL tool - see _nifti_fname. Other data is passed
+        # in shared memory or failing that a temporary file
+        self._cleanup()
+        try:
+            if os.name != "posix":
+                # Worker will return outputs in NIfTI files - see _run_fsl
+                self._tmpdir = tempfile.mkdtemp(prefix="qpfsl_")
+            for key, val in list(cmd_args.items()):
+                if not isinstance(val, QpData):
+                    continue
+                fname = _nifti_fname(val)
+                if fname:
+                    cmd_args[key] = fname
+                else:
+                    try:
+                        shm, cmd_args[key] = _share_qpdata(val)
+                        self._shm_blocks.append(shm)
+                    except (ImportError, OSError):
+                        cmd_args[key] = self._save_input(key, val)
+        except Exception:
+            # No worker will be started so sig_finished will not be emitted
+            self._cleanup()
+            raise
+
+        if os.name == "posix":
+            # Start the resource tracker now so the worker inherits it. Otherwise
+            # a forked worker starts its own tracker, which regards output blocks
+            # unlinked by this process as leaked - see _share_fslimage
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.ensure_running()
+            except ImportError:
+                pass
+
+        # Run as background process. Shared memory and temporary files are
+        # released by _run_finished however the run ends
+        args = [fsldir, fsldevdir, self._tmpdir, cmd, cmd_args]
         self.debug(args)
         self.start_bg(args, n_workers=1)
 
@@ -142,8 +477,7 @@ class FslProcess(Process):
         """
         self.debug("finished: %i", self.status)
         if self.status == Process.SUCCEEDED:
-
-            cmd_result = worker_output[0]
+            cmd_result = {key : _output_to_qpdata(val) for key, val in worker_output[0].items()}
             self.debug(cmd_result)
 
             self.debug(self._output_data)
@@ -164,22 +498,74 @@ class FslProcess(Process):
             if self._current_roi:
                 self.ivm.set_current_roi(self._current_roi)
             
+    def _save_input(self, key, qpd):
+        """
+        Save input data as an uncompressed NIfTI file in the temporary directory
+
+        :return: File name to pass to the worker in place of the data
+        """
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.mkdtemp(prefix="qpfsl_")
+        fname = os.path.join(self._tmpdir, "in_%s.nii" % key)
+        qpdata_to_fslimage(qpd).save(fname)
+        return fname
+
+    def _run_finished(self, *_args):
+        """
+        Release resources used by the run when it succeeds, fails or is cancelled
+        """
+        self._cleanup()
+
+    def _cleanup(self):
+        """
+        Release shared memory and temporary files used to pass data to and
+        from the worker
+        """
+        _close_shm(self._shm_blocks, unlink=True)
+        self._shm_blocks = []
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
     def timeout(self, queue):
         """
         Check the command output on the queue and if it matches
         an expected step, send sig_progress
+
+        All pending output is processed before sig_progress is sent, so
+        at most one progress update is emitted per call
+
+        The queue is created by Process.start_bg for each run of this
+        process instance, so it only ever contains output from our own
+        worker and is not shared with other FslProcess instances
         """
-        if queue.empty(): return
-        while not queue.empty():
-            line = queue.get()
-            self.debug(line)
-            if self._current_step < len(self._expected_steps):
-                expected = self._expected_steps[self._current_step]
-                if expected is not None and re.match(expected, line):
-                    self._current_step += 1
-                    complete = float(self._current_step) / (len(self._expected_steps)+1)
-                    self.debug(complete)
-                    self.sig_progress.emit(complete)
+        start_step = self._current_step
+        while True:
+            try:
+                lines = queue.get_nowait()
+            except _queue.Empty:
+                break
+
+            for line in lines:
+                self.debug(line)
+                if self._current_step < len(self._expected_regexes):
+                    expected = self._expected_regexes[self._current_step]
+                    if expected is not None and expected.match(line):
+                        self._current_step += 1
+
+        if self._current_step != start_step:
+            complete = float(self._current_step) / (len(self._expected_steps)+1)
+            self.debug(complete)
+            self.sig_progress.emit(complete)
+
+# Optional FAST outputs as (option, default, FAST flag, FAST output, name suffix, is ROI)
+_FAST_OUTPUTS = (
+    ("output-pveseg", True, None, "out_pveseg", "_pveseg", True),
+    ("output-rawseg", False, None, "out_seg", "_seg", True),
+    ("output-mixeltype", False, None, "out_mixeltype", "_mixeltype", True),
+    ("biasfield", False, "b", "out_bias", "_bias", False),
+    ("biascorr", False, "B", "out_restore", "_restore", False),
+)
 
 class FastProcess(FslProcess):
     """
@@ -191,27 +577,19 @@ class FastProcess(FslProcess):
         data = self.get_data(options)
 
         if options.pop("output-pve", True):
-            for classnum in range(options["class"]):
-                self._output_data["out_pve_%i" % classnum] = "%s_pve_%i" % (data.name, classnum)
+            self._output_data.update({"out_pve_%i" % classnum : "%s_pve_%i" % (data.name, classnum)
+                                      for classnum in range(options["class"])})
             self._current_data = "%s_pve_0" % data.name
-        
-        if options.pop("output-pveseg", True):
-            self._output_rois["out_pveseg"] = "%s_pveseg" % data.name
-            self._current_roi = self._output_rois["out_pveseg"]
-
-        if options.pop("output-rawseg", False):
-            self._output_rois["out_seg"] = "%s_seg" % data.name 
-
-        if options.pop("output-mixeltype", False):
-            self._output_rois["out_mixeltype"] = "%s_mixeltype" % data.name
 
-        if options.pop("biasfield", False):
-            options["b"] = True
-            self._output_data["out_bias"] = "%s_bias" % data.name
-
-        if options.pop("biascorr", False):
-            options["B"] = True
-            self._output_data["out_restore"] = "%s_restore" % data.name
+        for option, default, flag, output, suffix, roi in _FAST_OUTPUTS:
+            if options.pop(option, default):
+                if flag:
+                    options[flag] = True
+                if roi:
+                    self._output_rois[output] = data.name + suffix
+                else:
+                    self._output_data[output] = data.name + suffix
+        self._current_roi = self._output_rois.get("out_pveseg", None)
         
         self._expected_steps = ["Tanaka Iteration",] * (options.pop("iter", 4) + options.pop("fixed", 4))
 
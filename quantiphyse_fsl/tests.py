@@ -15,11 +15,25 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import os
+import queue
+import re
+import shutil
+import sys
+import tempfile
 import unittest
 
+import numpy as np
+
+from quantiphyse.data import NumpyData, DataGrid, ImageVolumeManagement, load
 from quantiphyse.processes import Process
 from quantiphyse.test import ProcessTest
 
+from .flirt import FlirtRegMethod
+from .process import FslProcess, FslOutputProgress, _share_qpdata, _shared_to_fslimage, _share_fslimage, \
+                     _shared_to_qpdata, _close_shm, _NiftiImage, _nifti_to_qpdata, \
+                     _nifti_fname
+
 class FlirtProcessTest(ProcessTest):
     
     def __init__(self, *args, **kwargs):
@@ -101,6 +115,36 @@ class FlirtProcessTest(ProcessTest):
         self.assertTrue("data_3d_flirtreg2" in self.ivm.data)
         # FIXME check if registered is the same as applied
 
+    def testRegBatch(self):
+        ref = NumpyData(self.data_3d, grid=self.grid, name="data_3d")
+        reg_list = [
+            NumpyData(self.data_3d, grid=self.grid, name="reg_a"),
+            NumpyData(self.data_3d * 2, grid=self.grid, name="reg_b"),
+            NumpyData(self.data_3d + 1, grid=self.grid, name="reg_c"),
+        ]
+        results = FlirtRegMethod.reg_batch(reg_list, ref, {}, None, n_workers=3)
+        self.assertEqual([qpdata.name for qpdata, _transform, _log in results], ["reg_a", "reg_b", "reg_c"])
+        for qpdata, transform, _log in results:
+            self.assertTrue(qpdata.grid.matches(ref.grid))
+            self.assertTrue(transform.ref_grid.matches(ref.grid))
+
+    def testMocoBatch(self):
+        # ProcessTest only loads the test data into the IVM when running a batch script
+        nvols = self.data_4d_moving.shape[3]
+        volumes = [NumpyData(self.data_4d_moving[..., idx], grid=self.grid, name="vol%i" % idx) for idx in range(nvols)]
+        corrected, transforms, _log = FlirtRegMethod.moco_batch(volumes, 0, {}, None)
+        self.assertEqual([qpdata.name for qpdata in corrected], [vol.name for vol in volumes])
+        self.assertEqual(len(transforms), len(volumes))
+        for qpdata in corrected:
+            self.assertEqual(qpdata.ndim, 3)
+
+    def testMocoBatchSingleVolume(self):
+        volumes = [NumpyData(self.data_4d_moving[..., 0], grid=self.grid, name="vol0")]
+        corrected, transforms, _log = FlirtRegMethod.moco_batch(volumes, 0, {}, None)
+        self.assertEqual(len(corrected), 1)
+        self.assertEqual(corrected[0].name, "vol0")
+        self.assertEqual(len(transforms), 1)
+
 class FnirtProcessTest(ProcessTest):
     """
     FNIRT registration method process tests
@@ -163,5 +207,195 @@ class FnirtProcessTest(ProcessTest):
 #         self.assertEqual(self.status, Process.SUCCEEDED)
 #         self.assertTrue("data_4d_fnirtreg" in self.ivm.data)
 
+class FslOutputProgressTest(unittest.TestCase):
+    """
+    Tests for the stream which sends FSL command output to the main process
+    """
+
+    def setUp(self):
+        self.queue = queue.Queue()
+        self.stream = FslOutputProgress(self.queue)
+
+    def _sent(self):
+        sent = []
+        while not self.queue.empty():
+            sent.append(self.queue.get_nowait())
+        return sent
+
+    def testPartialLines(self):
+        self.stream.write("Step ")
+        self.assertEqual(self._sent(), [])
+        self.stream.write("1\nStep 2\nStep")
+        self.assertEqual(self._sent(), [["Step 1", "Step 2"]])
+        self.stream.write(" 3\n")
+        self.assertEqual(self._sent(), [["Step 3"]])
+
+    def testLineEndings(self):
+        self.stream.write("Step 1\r\nStep 2\rStep 3\n")
+        self.assertEqual(self._sent(), [["Step 1", "Step 2", "Step 3"]])
+
+    def testFinish(self):
+        self.stream.write("Step 1\nDone")
+        self.stream.finish()
+        self.assertEqual(self._sent(), [["Step 1"], ["Done"]])
+        self.stream.finish()
+        self.assertEqual(self._sent(), [])
+
+@unittest.skipIf(os.name != "posix" or sys.version_info < (3, 8), "Shared memory not supported")
+class SharedMemoryTest(unittest.TestCase):
+    """
+    Tests for passing image data to and from the worker process in shared memory
+    """
+
+    def setUp(self):
+        self.affine = np.array([
+            [2.0, 0, 0, -10],
+            [0, 3.0, 0, 5],
+            [0, 0, 4.0, 1],
+            [0, 0, 0, 1],
+        ])
+
+    def testInputRoundTrip(self):
+        data = np.random.rand(5, 6, 7, 3).astype(np.float32)
+        qpd = NumpyData(data, grid=DataGrid((5, 6, 7), self.affine), name="data")
+        shm, shared = _share_qpdata(qpd)
+        try:
+            worker_shm, img = _shared_to_fslimage(shared)
+            self.assertEqual(img.name, "data")
+            self.assertEqual(img.dtype, np.float32)
+            self.assertEqual(tuple(img.shape), (5, 6, 7, 3))
+            self.assertTrue(np.array_equal(img.data, data))
+            self.assertTrue(np.allclose(img.voxToWorldMat, self.affine))
+            del img
+            _close_shm([worker_shm])
+        finally:
+            _close_shm([shm], unlink=True)
+
+    def testOutputRoundTrip(self):
+        from multiprocessing.shared_memory import SharedMemory
+        from fsl.data.image import Image
+        data = np.arange(5*6*7, dtype=np.int16).reshape((5, 6, 7))
+        shared = _share_fslimage(Image(data, xform=self.affine), "output")
+        qpd = _shared_to_qpdata(shared)
+        self.assertEqual(qpd.name, "output")
+        self.assertEqual(qpd.raw().dtype, np.int16)
+        self.assertEqual(tuple(qpd.grid.shape), (5, 6, 7))
+        self.assertTrue(np.array_equal(qpd.raw(), data))
+        self.assertTrue(np.allclose(qpd.grid.affine, self.affine))
+        with self.assertRaises(FileNotFoundError):
+            SharedMemory(name=shared.shm_name)
+
+class NiftiOutputTest(unittest.TestCase):
+    """
+    Tests for loading image data returned by the worker process in a NIfTI file
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testLoad(self):
+        import nibabel as nib
+        affine = np.diag([2.0, 3.0, 4.0, 1.0])
+        data = np.random.rand(5, 6, 7, 3).astype(np.float32)
+        fname = os.path.join(self.tmpdir, "output.nii")
+        nib.save(nib.Nifti1Image(data, affine), fname)
+
+        qpd = _nifti_to_qpdata(_NiftiImage(fname, "output"))
+        # Data must have been read into memory
+        os.remove(fname)
+        self.assertEqual(qpd.name, "output")
+        self.assertEqual(qpd.nvols, 3)
+        self.assertTrue(np.array_equal(qpd.raw(), data))
+        self.assertTrue(np.allclose(qpd.grid.affine, affine))
+
+class NiftiInputTest(unittest.TestCase):
+    """
+    Tests for passing input data to FSL commands by the NIfTI file it was loaded from
+    """
+
+    def setUp(self):
+        import nibabel as nib
+        self.tmpdir = tempfile.mkdtemp()
+        self.affine = np.diag([2.0, 3.0, 4.0, 1.0])
+        self.fname = os.path.join(self.tmpdir, "data.nii.gz")
+        self.data = np.random.rand(5, 6, 7).astype(np.float32)
+        nib.save(nib.Nifti1Image(self.data, self.affine), self.fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _numpy_data(self, data, affine):
+        return NumpyData(data, grid=DataGrid(data.shape[:3], affine), name="data", fname=self.fname)
+
+    def testMatchingFile(self):
+        self.assertEqual(_nifti_fname(load(self.fname)), self.fname)
+        self.assertEqual(_nifti_fname(self._numpy_data(self.data, self.affine)), self.fname)
+
+    def testMissingFile(self):
+        qpd = load(self.fname)
+        os.remove(self.fname)
+        self.assertTrue(_nifti_fname(qpd) is None)
+
+    def testNoFile(self):
+        qpd = NumpyData(self.data, grid=DataGrid(self.data.shape, self.affine), name="data")
+        self.assertTrue(_nifti_fname(qpd) is None)
+
+    def testRaw2dt(self):
+        qpd = load(self.fname)
+        qpd.set_2dt()
+        self.assertTrue(_nifti_fname(qpd) is None)
+
+        # Rejected even if the grid would still match the file
+        qpd = self._numpy_data(self.data, self.affine)
+        qpd.metadata["raw_2dt"] = True
+        self.assertTrue(_nifti_fname(qpd) is None)
+
+    def testShapeMismatch(self):
+        qpd = self._numpy_data(self.data[:, :, :5], self.affine)
+        self.assertTrue(_nifti_fname(qpd) is None)
+
+    def testVolumesMismatch(self):
+        data = np.stack([self.data, self.data], axis=-1)
+        qpd = self._numpy_data(data, self.affine)
+        self.assertTrue(_nifti_fname(qpd) is None)
+
+    def testAffineMismatch(self):
+        qpd = self._numpy_data(self.data, np.diag([1.0, 1.0, 1.0, 1.0]))
+        self.assertTrue(_nifti_fname(qpd) is None)
+
+class FslProcessTimeoutTest(unittest.TestCase):
+    """
+    Tests for the progress updates sent while an FSL command is running
+    """
+
+    def setUp(self):
+        self.process = FslProcess(ImageVolumeManagement())
+        self.process._expected_steps = ["Step 1", "Step 2", "Step 3"]
+        self.process._expected_regexes = [re.compile(step) for step in self.process._expected_steps]
+        self.process._current_step = 0
+        self.progress = []
+        self.process.sig_progress.connect(self._progress)
+        self.queue = queue.Queue()
+
+    def _progress(self, complete):
+        self.progress.append(complete)
+
+    def testSingleEmit(self):
+        self.queue.put(["Step 1", "Other output"])
+        self.queue.put(["Step 2"])
+        self.process.timeout(self.queue)
+        self.assertEqual(self.progress, [0.5])
+        self.assertTrue(self.queue.empty())
+
+    def testNoMatch(self):
+        self.queue.put(["Step 2", "Other output"])
+        self.process.timeout(self.queue)
+        self.process.timeout(self.queue)
+        self.assertEqual(self.progress, [])
+        self.assertTrue(self.queue.empty())
+
 if __name__ == '__main__':
     unittest.main()
@@ -21,22 +21,22 @@ from __future__ import division, unicode_literals, absolute_import, print_functi
 import sys
 import os
 import glob
+import collections
+import types
 
 from PySide2 import QtGui, QtCore, QtWidgets
 
-from fsl.data.atlases import AtlasRegistry
-
 import quantiphyse
 from quantiphyse.data import load, NumpyData
 from quantiphyse.gui.options import OptionBox, NumericOption, TextOption, OutputNameOption, DataOption, BoolOption, ChoiceOption, PickPointOption, FileOption
 from quantiphyse.gui.widgets import QpWidget, RunBox, TitleWidget, Citation, ElidedLabel
 from quantiphyse.utils import QpException
 
-from .process import FastProcess, BetProcess, FslAnatProcess, FslMathsProcess, fslimage_to_qpdata
+from .process import FastProcess, BetProcess, FslAnatProcess, FslMathsProcess, fslimage_to_qpdata, fsl_env, refresh_fsl_env
 
 from ._version import __version__
 
-CITATIONS = {
+CITATIONS = types.MappingProxyType({
     "fsl" : (
         "Advances in functional and structural MR image analysis and implementation as FSL",
         "S.M. Smith, M. Jenkinson, M.W. Woolrich, C.F. Beckmann, T.E.J. Behrens, H. Johansen-Berg, P.R. Bannister, M. De Luca, I. Drobnjak, D.E. Flitney, R. Niazy, J. Saunders, J. Vickers, Y. Zhang, N. De Stefano, J.M. Brady, and P.M. Matthews",
@@ -52,7 +52,14 @@ CITATIONS = {
         "S.M. Smith",
         "Human Brain Mapping, 17(3):143-155, November 2002."
     ),
-}
+})
+
+# Citation to display for each program - the general FSL citation unless there is a specific one
+_CITATION_FOR = collections.defaultdict(lambda: CITATIONS["fsl"], CITATIONS)
+
+# Set once FslDirWidget has looked for FSL in the saved settings and common
+# install locations. Any change made after that goes through refresh_fsl_env
+_FSL_DIRS_PROBED = False
 
 class FslDirWidget(QtWidgets.QFrame):
     """
@@ -121,24 +128,29 @@ class FslDirWidget(QtWidgets.QFrame):
         return fsldevdir
 
     def _get_fsl_dirs(self):
-        if not os.environ.get("FSLDIR", None):
-            if self._settings.contains("fslqp/fsldir"):
-                os.environ["FSLDIR"] = self._settings.value("fslqp/fsldir")
-            else:
-                places_to_try = [
-                    "/usr/local/fsl",
-                    "/opt/fsl",
-                ]
-                for place in places_to_try:
-                    if self._possible_fsldir(place):
-                        os.environ["FSLDIR"] = place
-                        break
-
-        if not os.environ.get("FSLDEVDIR", None):
-            if self._settings.contains("fslqp/fsldevdir"):
-                os.environ["FSLDEVDIR"] = self._settings.value("fslqp/fsldevdir")
-
-        return os.environ.get("FSLDIR", None), os.environ.get("FSLDEVDIR", None)
+        global _FSL_DIRS_PROBED
+        if not _FSL_DIRS_PROBED:
+            if not os.environ.get("FSLDIR", None):
+                if self._settings.contains("fslqp/fsldir"):
+                    os.environ["FSLDIR"] = self._settings.value("fslqp/fsldir")
+                else:
+                    places_to_try = [
+                        "/usr/local/fsl",
+                        "/opt/fsl",
+                    ]
+                    for place in places_to_try:
+                        if self._possible_fsldir(place):
+                            os.environ["FSLDIR"] = place
+                            break
+
+            if not os.environ.get("FSLDEVDIR", None):
+                if self._settings.contains("fslqp/fsldevdir"):
+                    os.environ["FSLDEVDIR"] = self._settings.value("fslqp/fsldevdir")
+
+            refresh_fsl_env()
+            _FSL_DIRS_PROBED = True
+
+        return fsl_env()
 
     def _change_fsldir(self):
         dialog = FslDirDialog(self.fsldir, self.fsldevdir)
@@ -152,6 +164,7 @@ class FslDirWidget(QtWidgets.QFrame):
                 self._settings.setValue("fslqp/fsldevdir", dialog.fsldevdir)
             else:
                 self._settings.setValue("fslqp/fsldevdir", "")
+            refresh_fsl_env()
 
             self._update_label()
             self.sig_changed.emit(self.fsldir)
@@ -241,52 +254,86 @@ class FslWidget(QpWidget):
     """
     Widget providing interface to FSL program
     """
+    PROCESS_CLS = None
+
     def __init__(self, **kwargs):
         QpWidget.__init__(self, icon="fsl.png", group="FSL", **kwargs)
         self.prog = kwargs["prog"]
+        self._options_populated = False
         
     def init_ui(self, run_box=True):
         self.vbox = QtWidgets.QVBoxLayout()
         self.setLayout(self.vbox)
         
         title = TitleWidget(self, help="fsl", subtitle="%s %s" % (self.description, __version__))
-        self.vbox.addWidget(title)
-
-        cite = Citation(*CITATIONS.get(self.prog, CITATIONS["fsl"]))
-        self.vbox.addWidget(cite)
-
+        cite = Citation(*_CITATION_FOR[self.prog])
         self.options = OptionBox("%s options" % self.prog.upper())
-        self.vbox.addWidget(self.options)
-        
+        widgets = [title, cite, self.options] + self.extra_widgets()
         if run_box:
             self.run_box = RunBox(self.get_process, self.get_options)
-            self.vbox.addWidget(self.run_box)
-        
+            widgets.append(self.run_box)
+
+        for widget in widgets:
+            self.vbox.addWidget(widget)
         self.vbox.addStretch(1)
 
         fsldir = FslDirWidget()
         self.vbox.addWidget(fsldir)
         fsldir.sig_changed.connect(self._fsldir_changed)
         self._fsldir_changed(fsldir.fsldir)
+
+        # Options are added once the event loop is idle so the rest of the
+        # widget can be displayed first. get_options will add them immediately
+        # if they are needed before then
+        QtCore.QTimer.singleShot(0, self._populate_options)
+
+    def extra_widgets(self):
+        """
+        :return: List of program-specific widgets to display below the options
+        """
+        return []
+
+    def populate_options(self):
+        """
+        Add the program-specific options to self.options
+
+        Implemented by subclasses
+        """
+        pass
+
+    def _populate_options(self):
+        if not self._options_populated:
+            self._options_populated = True
+            self.populate_options()
         
     def _fsldir_changed(self, fsldir):
         self.options.setVisible(bool(fsldir))
         if hasattr(self, "run_box"):
             self.run_box.setVisible(bool(fsldir))
 
+    def get_process(self):
+        """
+        :return: New instance of the process which runs the FSL program
+
+        A new instance is created for every run because RunBox connects to
+        the signals of each process it is given
+        """
+        return self.PROCESS_CLS(self.ivm)
+
     def batch_options(self):
-        return self.get_process().PROCESS_NAME, self.get_options()
+        return self.PROCESS_CLS.PROCESS_NAME, self.get_options()
 
     def get_options(self):
+        self._populate_options()
         return self.options.values()
 
 class FastWidget(FslWidget):
+    PROCESS_CLS = FastProcess
+
     def __init__(self, **kwargs):
         FslWidget.__init__(self, prog="fast", description="FMRIB Automated Segmentation Tool", name="FAST", **kwargs)
     
-    def init_ui(self):
-        FslWidget.init_ui(self)
-        
+    def populate_options(self):
         self.options.add("Structural image (brain extracted)", DataOption(self.ivm, include_4d=False), key="data")
         self.options.add("Image type", ChoiceOption(["T1 weighted", "T2 weighted", "Proton Density"], return_values=[1, 2, 3]), key="type")
         self.options.add("Number of tissue type classes", NumericOption(intonly=True, minval=2, maxval=10, default=3), key="class")
@@ -300,17 +347,19 @@ class FastWidget(FslWidget):
         self.options.add("Initial segmentation spatial smoothness", NumericOption(minval=0, maxval=1, default=0.02), key="fHard")
         self.options.add("Spatial smoothness for mixeltype", NumericOption(minval=0, maxval=5, default=0.3), key="mixel")
         self.options.add("Segmentation spatial smoothness", NumericOption(minval=0, maxval=5, default=0.1), key="Hyper")
-        
-    def get_process(self):
-        return FastProcess(self.ivm)
 
 class BetWidget(FslWidget):
+    PROCESS_CLS = BetProcess
+
     def __init__(self, **kwargs):
         FslWidget.__init__(self, prog="bet", description="Brain Extraction Tool", name="BET", **kwargs)
+        self._grid_data = None
+        self._grid_timer = QtCore.QTimer(self)
+        self._grid_timer.setSingleShot(True)
+        self._grid_timer.setInterval(100)
+        self._grid_timer.timeout.connect(self._apply_grid)
     
-    def init_ui(self):
-        FslWidget.init_ui(self)
-        
+    def populate_options(self):
         data = self.options.add("Input data", DataOption(self.ivm), key="data")
         data.sig_changed.connect(self._data_changed)
         self.options.add("Output extracted brain image", OutputNameOption(src_data=data, suffix="_brain"), key="output-brain", checked=True, enabled=True)
@@ -320,19 +369,23 @@ class BetWidget(FslWidget):
         self.centre = self.options.add("Brain centre (raw co-ordinates)", PickPointOption(self.ivl), key="centre", checked=True)
 
     def _data_changed(self):
-        if self.options.values()["data"] in self.ivm.data:
-            self.centre.setGrid(self.ivm.data[self.options.values()["data"]].grid)
+        # Wait until the selection has settled, e.g. when scrolling through
+        # the data list, rather than reconfiguring the point picker each time
+        self._grid_timer.start()
 
-    def get_process(self):
-        return BetProcess(self.ivm)
+    def _apply_grid(self):
+        data_name = self.options.values()["data"]
+        if data_name != self._grid_data and data_name in self.ivm.data:
+            self.centre.setGrid(self.ivm.data[data_name].grid)
+            self._grid_data = data_name
 
 class FslAnatWidget(FslWidget):
+    PROCESS_CLS = FslAnatProcess
+
     def __init__(self, **kwargs):
         FslWidget.__init__(self, prog="fsl_anat", description="Anatomical segmentation from structural image", name="FSL_ANAT", **kwargs)
     
-    def init_ui(self):
-        FslWidget.init_ui(self)
-        
+    def populate_options(self):
         self.options.add("Input structural data", DataOption(self.ivm), key="data")
         self.options.add("Image type", ChoiceOption(["T1 weighted", "T2 weighted", "Proton Density"], return_values=["T1", "T2", "PD"]), key="img_type")
         self.options.add("Strong bias field", BoolOption(), key="strongbias")
@@ -346,29 +399,28 @@ class FslAnatWidget(FslWidget):
         self.options.add("BET Intensity threshold", NumericOption(minval=0, maxval=1, default=0.5), key="betfparam")
         self.options.add("Bias field smoothing extent (mm)", NumericOption(minval=0, maxval=100, default=20), key="bias_smoothing")
 
-    def get_process(self):
-        return FslAnatProcess(self.ivm)
-
 class FslMathsWidget(FslWidget):
+    PROCESS_CLS = FslMathsProcess
+
     def __init__(self, **kwargs):
         FslWidget.__init__(self, prog="fslmaths", description="Miscellaneous data processing", name="FSL Maths", **kwargs)
     
     def init_ui(self):
         FslWidget.init_ui(self, run_box=False)
+
+    def populate_options(self):
         run_btn = QtWidgets.QPushButton("Run")
         run_btn.clicked.connect(self._run)
         self.options.add("Command string", TextOption(), run_btn, key="cmd")
 
+    def extra_widgets(self):
         doc = QtWidgets.QLabel("Enter the fslmaths command line string as you would normally. Use the names of the Quantiphyse data sets you want to use as filenames")
         doc.setWordWrap(True)
-        self.vbox.insertWidget(self.vbox.count()-1, doc)
+        return [doc]
 
     def _run(self):
         self.get_process().run(self.get_options())
 
-    def get_process(self):
-        return FslMathsProcess(self.ivm)
-
 class FslAtlasWidget(QpWidget):
     """
     Widget for browsing and loading FSL atlases
@@ -376,9 +428,14 @@ class FslAtlasWidget(QpWidget):
 
     def __init__(self, **kwargs):
         super(FslAtlasWidget, self).__init__(name="Atlases", icon="fsl.png", desc="Browse and display FSL atlases", group="FSL", **kwargs)
-        self._registry = AtlasRegistry()
+        self._registry = None
 
     def init_ui(self):  
+        # Importing the atlas registry pulls in a large part of fslpy so
+        # defer it until the widget is actually used
+        from fsl.data.atlases import AtlasRegistry
+        self._registry = AtlasRegistry()
+
         vbox = QtWidgets.QVBoxLayout()
         vbox.setSpacing(1)
         self.setLayout(vbox)